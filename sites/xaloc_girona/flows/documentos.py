@@ -4,283 +4,581 @@ Flujo de subida de documentos (adjuntos) vía popup uploader.
 
 from __future__ import annotations
 
+import asyncio
 import logging
-import re
 import os
 import shutil
+import string
+import tempfile
 import time
-import uuid
 from pathlib import Path
-from typing import List, Optional, Sequence, Union
+from typing import Any, List, Sequence, Union
 
 from playwright.async_api import Error as PlaywrightError
-from playwright.async_api import Frame
+from playwright.async_api import Frame, Locator
 from playwright.async_api import Page, TimeoutError
 
-DELAY_MS = 500
+logger = logging.getLogger(__name__)
+
 POPUP_TIMEOUT_MS = 15000
+POPUP_LOAD_TIMEOUT_MS = 15000
 UPLOADS_TRANSIT_DIR = Path("tmp/web_uploads")
+UPLOAD_WARN_BYTES = 16 * 1024 * 1024
+FILE_INPUT_TIMEOUT_MS = 10000
+# Espera del "Document adjuntat": suelo fijo más un margen proporcional al tamaño (~1 MB/s).
+UPLOAD_OK_MIN_TIMEOUT_MS = 20000
+UPLOAD_OK_BYTES_PER_MS = 1000
+
+# Instrumentación de diagnóstico (hooks STA con log GEMINI_DEBUG vía __xalocLog y dumps del popup).
+# Se evalúa una vez al importar: en producción no se instala nada.
+_TRUTHY = frozenset({"1", "true"})
+_DEBUG = (os.getenv("XALOC_UPLOAD_DEBUG") or "0").strip().lower() in _TRUTHY
+# Conservar la carpeta de tránsito tras la subida (diagnóstico).
+_KEEP_TRANSIT = (os.getenv("XALOC_KEEP_UPLOAD_TRANSIT") or "0").strip().lower() in _TRUTHY
+# Captura de verificación tras cada subida correcta (diagnóstico).
+_DEBUG_SCREENSHOTS = (os.getenv("XALOC_DEBUG_SCREENSHOTS") or "0").strip().lower() in _TRUTHY
+
+# Referencias fuertes a los cierres de popup lanzados en segundo plano (evita que el GC los cancele).
+_TAREAS_CIERRE: set[asyncio.Task[None]] = set()
+
+# Textos literales: has_text con str ya es substring sin distinguir mayúsculas y evita serializar un regex.
+_CLICAR_TXT = "Clicar per adjuntar"
+_CONTINUAR_TXT = "Continuar"
+_CONTINUAR_LINK = "a:text-is('Continuar')"
+_CONTINUAR_CSS = "#continuar a"
+# Caracteres que conserva el sanitize del popup STA: [a-zA-Z0-9-_.]
+_STA_SAFE_CHARS = frozenset(string.ascii_letters + string.digits + "-_.")
+_ALLOWED_EXTS = frozenset({"jpg", "jpeg", "pdf"})
+_UPLOAD_URL_HINTS = ("upload", "adjuntar")
+
+# Predicado "subida OK" del popup STA: <div id="uploadResultado">... Document adjuntat</div>
+_UPLOAD_OK_JS = """() => {
+    const el = document.getElementById('uploadResultado');
+    if (!el) return false;
+    return /Document\\s+adjuntat/i.test(el.textContent || '');
+}"""
+
+# Misma condición, pero resuelta por un MutationObserver (sin sondeo). Devuelve:
+# - 'ok': apareció "Document adjuntat";
+# - 'absent': #uploadResultado no existe tras `absentMs` (no se puede validar por texto);
+# - 'timeout': el indicador existe pero no mostró el OK en `timeoutMs`.
+_UPLOAD_OK_OBSERVER_JS = """({ timeoutMs, absentMs }) => new Promise((resolve) => {
+    const check = () => {
+        const el = document.getElementById('uploadResultado');
+        return !!el && /Document\\s+adjuntat/i.test(el.textContent || '');
+    };
+    if (check()) return resolve('ok');
+    let absentTimer = null;
+    const finish = (result) => {
+        obs.disconnect();
+        clearTimeout(timer);
+        if (absentTimer) clearTimeout(absentTimer);
+        resolve(result);
+    };
+    const obs = new MutationObserver(() => {
+        if (check()) finish('ok');
+    });
+    const timer = setTimeout(() => finish('timeout'), timeoutMs);
+    absentTimer = setTimeout(() => {
+        if (!document.getElementById('uploadResultado')) finish('absent');
+    }, absentMs);
+    obs.observe(document.documentElement, { childList: true, subtree: true, characterData: true });
+})"""
+
+# Estado del popup/iframe (inputs de archivo, #uploadResultado, #continuar) para _debug_dump_popup_state.
+_DUMP_POPUP_STATE_JS = """({ label, expectedFiles }) => {
+    const safeText = (el) => (el && (el.textContent || '') || '').trim();
+    const safeStyle = (el) => {
+        if (!el) return null;
+        const cs = window.getComputedStyle(el);
+        return {
+            display: cs.display,
+            visibility: cs.visibility,
+            opacity: cs.opacity,
+            pointerEvents: cs.pointerEvents,
+        };
+    };
 
-
-def _attach_gemini_console_logger(page: Page) -> None:
+    const inputs = Array.from(document.querySelectorAll('input[type="file"]')).map((input) => {
+        const files = input.files ? Array.from(input.files).map((f) => ({ name: f.name, size: f.size })) : [];
+        return {
+            id: input.id || null,
+            name: input.name || null,
+            value: input.value || '',
+            filesCount: files.length,
+            files,
+        };
+    });
+
+    const uploadResultado = document.getElementById('uploadResultado');
+    const continuarDiv = document.getElementById('continuar');
+    const fileHidden = document.getElementById('file');
+
+    // expectedFiles ya llega en minúsculas; normalizamos valores y nombres una sola vez.
+    const valoresLower = inputs.map((i) => (i.value || '').toLowerCase());
+    const nombresLower = inputs.flatMap((i) => (i.files || []).map((ff) => (ff.name || '').toLowerCase()));
+    const expectedPresence = (expectedFiles || []).map((f) => ({
+        file: f,
+        inAnyInputValue: valoresLower.some((v) => v.includes(f)),
+        inAnyFileName: nombresLower.some((n) => n.includes(f)),
+    }));
+
+    const payload = {
+        label,
+        url: String(document.location),
+        inputs,
+        uploadResultado: {
+            text: safeText(uploadResultado),
+            style: safeStyle(uploadResultado),
+        },
+        continuar: {
+            style: safeStyle(continuarDiv),
+            hasLink: !!(continuarDiv && continuarDiv.querySelector('a')),
+        },
+        hiddenFile: fileHidden ? { value: fileHidden.value || '' } : null,
+        expectedPresence,
+    };
+
+    return payload;
+}"""
+
+# Registra en el opener la lista completa de archivos (addDocumentoLista + HEX) y actualiza su tabla.
+_SYNC_OPENER_JS = """(names) => {
+    const params = new URLSearchParams(window.location.search);
+    
+    const toHex = (str) => {
+        let hex = '';
+        for(let i=0; i<str.length; i++) hex += ''+str.charCodeAt(i).toString(16);
+        return hex;
+    };
+
+    const fullString = names.join('|');
+    const data = {
+        tipoDoc: params.get('tipoDocumento') || '',
+        personId: params.get('personDBOID') || '',
+        firma: params.get('firma') || 'S',
+        filesStr: fullString,
+        allFilesHex: toHex(fullString), // Convertimos la cadena completa "A.pdf|B.pdf|C.pdf"
+        displayNames: names.join(', ')
+    };
+
+    if (!window.opener || window.opener.closed) return { filesStr: data.filesStr, patched: false };
+    const o = window.opener;
+    const d = o.document;
+
+    // A. Registrar la lista completa en el sistema técnico
+    o.addDocumentoLista(data.tipoDoc, data.filesStr, data.firma, '', '', '', data.personId, false, '', '', 'false', null, 'true');
+
+    // B. Actualizar IDs dinámicos (Soportando particular y representante)
+    const suffixes = ['_NEW', '_' + data.personId];
+    
+    suffixes.forEach(sfx => {
+        const idBase = data.tipoDoc + sfx;
+        
+        // Inyectar el HEX de TODOS los archivos (esto es lo que faltaba)
+        const fileInput = d.getElementById(idBase + 'file');
+        if (fileInput) fileInput.value = data.allFilesHex;
+
+        // Gestión de botones
+        const divBtn = d.getElementById('divBoton' + idBase);
+        const divCan = d.getElementById('divCancelar' + idBase);
+        if (divBtn) divBtn.style.display = 'none';
+        if (divCan) divCan.style.display = 'block';
+
+        // Actualización visual de la tabla con todos los nombres
+        const statusCell = d.getElementById('Status' + idBase);
+        if (statusCell) {
+            statusCell.innerHTML = '<span class="adjuntado pdf">' + data.displayNames + '</span>';
+        }
+    });
+    return { filesStr: data.filesStr, patched: true };
+}"""
+
+# Helpers instalados una vez por contexto (init script): cada popup los trae ya compilados
+# y `_evaluar_helper` solo envía la llamada, no el cuerpo de la función.
+_XALOC_HELPERS_SCRIPT = (
+    f"window.__xalocUploadReady = {_UPLOAD_OK_JS};\n"
+    f"window.__xalocWaitUploadOk = {_UPLOAD_OK_OBSERVER_JS};\n"
+    f"window.__xalocSyncOpener = {_SYNC_OPENER_JS};\n"
+)
+if _DEBUG:
+    _XALOC_HELPERS_SCRIPT += f"window.__xalocDumpPopupState = {_DUMP_POPUP_STATE_JS};\n"
+
+
+def _log_desde_navegador(mensaje: str) -> None:
+    logger.info("GEMINI_DEBUG: %s", mensaje)
+
+
+async def _instalar_log_navegador(page: Page) -> None:
     """
-    Captura console.log del navegador para diagnóstico remoto.
-    Solo registra mensajes que empiecen por 'GEMINI_DEBUG:'.
+    Expone `window.__xalocLog(msg)` en todo el contexto (una sola vez) para la instrumentación de
+    diagnóstico: llamada directa a Python, sin escuchar ni filtrar todos los eventos de consola.
+    No-op salvo con XALOC_UPLOAD_DEBUG=1.
     """
-    try:
-        # Evitar duplicar listeners si se llama más de una vez.
-        if getattr(page, "_gemini_console_logger_attached", False):
-            return
-        setattr(page, "_gemini_console_logger_attached", True)
-    except Exception:
-        # Si Playwright/objetos proxied no permiten atributos, ignoramos.
+    if not _DEBUG:
         return
-
-    def _on_console(msg):  # type: ignore[no-untyped-def]
-        try:
-            text = msg.text()
-            if isinstance(text, str) and text.startswith("GEMINI_DEBUG:"):
-                logging.info(text)
-        except Exception:
-            return
-
-    page.on("console", _on_console)
+    context = page.context
+    if getattr(context, "_xaloc_log_bridge_installed", False):
+        return
+    try:
+        await context.expose_function("__xalocLog", _log_desde_navegador)
+        setattr(context, "_xaloc_log_bridge_installed", True)
+    except Exception as e:
+        logger.warning("No se pudo exponer __xalocLog en el contexto: %s", e)
 
 
-async def _install_sta_main_hooks(page: Page) -> None:
+async def _instalar_helpers_contexto(page: Page) -> None:
     """
-    Instala hooks en la página principal ANTES de abrir el popup.
-    El popup llama a funciones del opener (p.ej. addDocumentoLista), y queremos ver sus argumentos.
+    Registra `_XALOC_HELPERS_SCRIPT` como init script del contexto (una sola vez por contexto).
+    Debe llamarse antes de abrir el popup para que este ya nazca con los helpers.
     """
+    context = page.context
+    if getattr(context, "_xaloc_helpers_installed", False):
+        return
     try:
-        await page.evaluate(
-            """() => {
-                if (window.__GEMINI_STA_HOOKS_INSTALLED) return;
-                window.__GEMINI_STA_HOOKS_INSTALLED = true;
-
-                function installHook(fnName) {
-                    function wrapAndLog(fn) {
-                        return function() {
-                            try {
-                                console.log('GEMINI_DEBUG: ' + fnName + '_args ' + JSON.stringify(Array.from(arguments)));
-                            } catch (e) {}
-                            try {
-                                const res = fn.apply(this, arguments);
-                                try {
-                                    console.log('GEMINI_DEBUG: ' + fnName + '_ok');
-                                } catch (e) {}
-                                return res;
-                            } catch (e) {
-                                try {
-                                    console.log('GEMINI_DEBUG: ' + fnName + '_throw ' + String(e && e.message ? e.message : e));
-                                } catch (e2) {}
-                                throw e;
-                            }
-                        };
-                    }
+        await context.add_init_script(script=_XALOC_HELPERS_SCRIPT)
+        setattr(context, "_xaloc_helpers_installed", True)
+    except Exception as e:
+        logger.warning("No se pudieron registrar los helpers de subida en el contexto: %s", e)
+
 
+async def _evaluar_helper(ctx: Page | Frame, helper: str, source: str, arg: Any) -> Any:
+    """
+    Invoca `window.<helper>(arg)` si el documento trae los helpers del init script; si no
+    (popup abierto antes de registrarlos, contexto ajeno), envía el cuerpo completo `source`.
+    """
+    result = await ctx.evaluate(
+        f"(a) => typeof window.{helper} === 'function' ? window.{helper}(a) : null",
+        arg,
+    )
+    if result is None:
+        result = await ctx.evaluate(source, arg)
+    return result
+
+
+# Hooks de diagnóstico sobre las funciones del opener que invoca el popup (addDocumentoLista, openUploader).
+_STA_HOOKS_JS = """() => {
+    if (window.__GEMINI_STA_HOOKS_INSTALLED) return;
+    window.__GEMINI_STA_HOOKS_INSTALLED = true;
+    // Puente directo a Python (expose_function); sin él no se registra nada.
+    const log = (msg) => {
+        try {
+            if (typeof window.__xalocLog === 'function') window.__xalocLog(msg);
+        } catch (e) {}
+    };
+
+    function installHook(fnName) {
+        function wrapAndLog(fn) {
+            return function() {
+                try {
+                    // Sin JSON: primitivos tal cual, nodos/objetos (File, FileList...) como su tipo; máx. 8.
+                    const resumen = Array.prototype.slice.call(arguments, 0, 8).map((a) => {
+                        const t = typeof a;
+                        if (t === 'string' || t === 'number' || t === 'boolean') return String(a);
+                        if (a === null) return 'null';
+                        return a && a.nodeType ? '[Node]' : t;
+                    });
+                    log(fnName + '_args n=' + arguments.length + ' ' + resumen.join('|'));
+                } catch (e) {}
+                try {
+                    const res = fn.apply(this, arguments);
                     try {
-                        const existing = window[fnName];
-                        if (typeof existing === 'function') {
-                            window[fnName] = wrapAndLog(existing);
-                            console.log('GEMINI_DEBUG: hook_installed ' + fnName + ' (direct)');
-                            return;
-                        }
+                        log(fnName + '_ok');
                     } catch (e) {}
-
-                    // Si aún no existe, definimos setter para envolver cuando se asigne.
+                    return res;
+                } catch (e) {
+                    try {
+                        log(fnName + '_throw ' + String(e && e.message ? e.message : e));
+                    } catch (e2) {}
+                    throw e;
+                }
+            };
+        }
+
+        try {
+            const existing = window[fnName];
+            if (typeof existing === 'function') {
+                window[fnName] = wrapAndLog(existing);
+                log('hook_installed ' + fnName + ' (direct)');
+                return;
+            }
+        } catch (e) {}
+
+        // Si aún no existe, definimos setter para envolver cuando se asigne.
+        try {
+            let current;
+            Object.defineProperty(window, fnName, {
+                configurable: true,
+                enumerable: true,
+                get: () => current,
+                set: (v) => {
                     try {
-                        let current;
-                        Object.defineProperty(window, fnName, {
-                            configurable: true,
-                            enumerable: true,
-                            get: () => current,
-                            set: (v) => {
-                                try {
-                                    if (typeof v === 'function') {
-                                        current = wrapAndLog(v);
-                                        console.log('GEMINI_DEBUG: hook_installed ' + fnName + ' (setter)');
-                                    } else {
-                                        current = v;
-                                    }
-                                } catch (e) {
-                                    current = v;
-                                }
-                            },
-                        });
-                        console.log('GEMINI_DEBUG: hook_waiting ' + fnName);
+                        if (typeof v === 'function') {
+                            current = wrapAndLog(v);
+                            log('hook_installed ' + fnName + ' (setter)');
+                        } else {
+                            current = v;
+                        }
                     } catch (e) {
-                        console.log('GEMINI_DEBUG: hook_failed ' + fnName + ' ' + String(e && e.message ? e.message : e));
+                        current = v;
                     }
-                }
+                },
+            });
+            log('hook_waiting ' + fnName);
+        } catch (e) {
+            log('hook_failed ' + fnName + ' ' + String(e && e.message ? e.message : e));
+        }
+    }
 
-                // Funciones relevantes para el puente popup -> opener
-                installHook('addDocumentoLista');
-                installHook('openUploader');
-            }"""
-        )
+    // Funciones relevantes para el puente popup -> opener
+    installHook('addDocumentoLista');
+    installHook('openUploader');
+}"""
+
+
+# Versión init script de los hooks: solo en la ventana principal (no en el popup ni en iframes).
+_STA_HOOKS_INIT_SCRIPT = f"if (window.top === window && !window.opener) ({_STA_HOOKS_JS})();\n"
+
+
+async def _install_sta_main_hooks(page: Page) -> None:
+    """
+    Instala hooks en la página principal ANTES de abrir el popup.
+    El popup llama a funciones del opener (p.ej. addDocumentoLista), y queremos ver sus argumentos.
+    Se registran como init script una vez por contexto (cubre navegaciones posteriores) y se
+    evalúan una sola vez en el documento ya cargado. No-op salvo con XALOC_UPLOAD_DEBUG=1.
+    """
+    if not _DEBUG:
+        return
+    # El puente de log debe existir antes de que los hooks empiecen a registrar.
+    await _instalar_log_navegador(page)
+    try:
+        context = page.context
+        if not getattr(context, "_xaloc_sta_hooks_installed", False):
+            await context.add_init_script(script=_STA_HOOKS_INIT_SCRIPT)
+            setattr(context, "_xaloc_sta_hooks_installed", True)
+        if not getattr(page, "_xaloc_sta_hooks_installed", False):
+            await page.evaluate(_STA_HOOKS_JS)
+            setattr(page, "_xaloc_sta_hooks_installed", True)
     except Exception as e:
-        logging.warning(f"No se pudo instalar hooks STA en la página principal: {e}")
+        logger.warning("No se pudo instalar hooks STA en la página principal: %s", e)
 
 
 def _sta_sanitize_filename(name: str) -> str:
     # Mismo sanitize que en el JS del popup: fileName.replace(/[^a-zA-Z0-9-_\.]/g, '')
-    return re.sub(r"[^a-zA-Z0-9\-_.]", "", name or "")
+    return "".join(c for c in (name or "") if c in _STA_SAFE_CHARS)
+
+
+def _enlazar_o_copiar(origen: Path, destino: Path) -> None:
+    # Hardlink si origen y destino comparten volumen (sin mover bytes); si no (p.ej. \\SERVER-DOC), copia simple.
+    # Playwright solo lee el contenido: no hace falta conservar metadatos como copy2.
+    # Nunca se escribe sobre un destino existente: podría ser un enlace a otro original del usuario.
+    try:
+        os.link(origen, destino)
+    except FileExistsError:
+        raise
+    except OSError:
+        # Copia con creación exclusiva ("xb"): si el destino apareció entretanto, falla en vez de sobrescribir.
+        with open(origen, "rb") as src, open(destino, "xb") as dst:
+            shutil.copyfileobj(src, dst)
+
+
+def _borrar_transit(run_dir: Path) -> None:
+    # La carpeta de tránsito es plana (solo enlaces/copias): basta un scandir + unlink, sin recorrido recursivo.
+    try:
+        with os.scandir(run_dir) as it:
+            for entry in it:
+                try:
+                    os.unlink(entry.path)
+                except OSError:
+                    pass
+        os.rmdir(run_dir)
+    except OSError:
+        pass
 
 
-def _preparar_copias_sanitizadas(archivos_originales: List[Path]) -> tuple[List[Path], Path]:
+async def _preparar_copias_sanitizadas(archivos_originales: Sequence[Path]) -> tuple[List[Path], Path | None]:
     """
     Copia los archivos a una carpeta temporal con nombres 100% compatibles con STA
     (misma sanitización que aplica el popup al construir la lista de archivos).
+    Si todos los nombres ya son válidos y distintos, se usan los originales y no hay carpeta (None).
     """
-    run_dir = UPLOADS_TRANSIT_DIR / f"{int(time.time())}_{uuid.uuid4().hex[:8]}"
-    run_dir.mkdir(parents=True, exist_ok=True)
+    nombres = [a.name for a in archivos_originales]
+    # Unicidad sin distinguir mayúsculas (como NTFS): "A.pdf" y "a.pdf" de carpetas distintas colisionan.
+    if len({n.casefold() for n in nombres}) == len(nombres) and all(_STA_SAFE_CHARS.issuperset(n) for n in nombres):
+        return list(archivos_originales), None
+
+    # mkdtemp crea la carpeta de esta ejecución con nombre único de forma atómica.
+    UPLOADS_TRANSIT_DIR.mkdir(parents=True, exist_ok=True)
+    run_dir = Path(tempfile.mkdtemp(prefix=f"{int(time.time())}_", dir=UPLOADS_TRANSIT_DIR))
 
     archivos_limpios: list[Path] = []
+    usados: set[str] = set()
     for i, ruta_orig in enumerate(archivos_originales, 1):
         nombre_limpio = _sta_sanitize_filename(ruta_orig.name)
         if not nombre_limpio:
             nombre_limpio = f"file_{i}"
 
-        destino = run_dir / nombre_limpio
         # Evitar colisiones si dos ficheros acaban con el mismo nombre sanitizado
-        if destino.exists():
-            destino = run_dir / f"{i}_{nombre_limpio}"
-
-        shutil.copy2(ruta_orig, destino)
-        logging.info(f"[UPLOAD_TRANSIT] Copia temporal: {ruta_orig} -> {destino.name}")
-        archivos_limpios.append(destino)
+        # (sin distinguir mayúsculas: en NTFS "Doc1.pdf" y "doc1.pdf" son el mismo fichero)
+        while nombre_limpio.casefold() in usados:
+            nombre_limpio = f"{i}_{nombre_limpio}"
+        usados.add(nombre_limpio.casefold())
+        archivos_limpios.append(run_dir / nombre_limpio)
+
+    # Los destinos ya están decididos: enlazamos/copiamos todos en paralelo fuera del event loop.
+    await asyncio.gather(
+        *(asyncio.to_thread(_enlazar_o_copiar, o, d) for o, d in zip(archivos_originales, archivos_limpios))
+    )
+    logger.debug("[UPLOAD_TRANSIT] %d copia(s) temporales en %s", len(archivos_limpios), run_dir)
 
     return archivos_limpios, run_dir
 
 
 async def _debug_dump_popup_state(ctx: Page | Frame, *, label: str, expected_files: list[str]) -> None:
     """
-    Log (Python + console) del estado del popup/iframe, para diagnosticar por qué desaparecen adjuntos.
+    Log del estado del popup/iframe, para diagnosticar por qué desaparecen adjuntos.
+    Solo se llama con XALOC_UPLOAD_DEBUG=1 (el guardado está en los llamadores).
     """
     try:
-        state = await ctx.evaluate(
-            """({ label, expectedFiles }) => {
-                const safeText = (el) => (el && (el.textContent || '') || '').trim();
-                const safeStyle = (el) => {
-                    if (!el) return null;
-                    const cs = window.getComputedStyle(el);
-                    return {
-                        display: cs.display,
-                        visibility: cs.visibility,
-                        opacity: cs.opacity,
-                        pointerEvents: cs.pointerEvents,
-                    };
-                };
-
-                const inputs = Array.from(document.querySelectorAll('input[type="file"]')).map((input) => {
-                    const files = input.files ? Array.from(input.files).map((f) => ({ name: f.name, size: f.size })) : [];
-                    return {
-                        id: input.id || null,
-                        name: input.name || null,
-                        value: input.value || '',
-                        filesCount: files.length,
-                        files,
-                    };
-                });
-
-                const uploadResultado = document.getElementById('uploadResultado');
-                const continuarDiv = document.getElementById('continuar');
-                const fileHidden = document.getElementById('file');
-
-                const expectedPresence = (expectedFiles || []).map((f) => ({
-                    file: f,
-                    inAnyInputValue: inputs.some((i) => (i.value || '').toLowerCase().includes(String(f).toLowerCase())),
-                    inAnyFileName: inputs.some((i) => (i.files || []).some((ff) => (ff.name || '').toLowerCase().includes(String(f).toLowerCase()))),
-                }));
-
-                const payload = {
-                    label,
-                    url: String(document.location),
-                    inputs,
-                    uploadResultado: {
-                        text: safeText(uploadResultado),
-                        style: safeStyle(uploadResultado),
-                    },
-                    continuar: {
-                        style: safeStyle(continuarDiv),
-                        hasLink: !!(continuarDiv && continuarDiv.querySelector('a')),
-                    },
-                    hiddenFile: fileHidden ? { value: fileHidden.value || '' } : null,
-                    expectedPresence,
-                };
-
-                console.log('GEMINI_DEBUG: popup_state ' + JSON.stringify(payload));
-                return payload;
-            }""",
-            {"label": label, "expectedFiles": expected_files},
+        state = await _evaluar_helper(
+            ctx,
+            "__xalocDumpPopupState",
+            _DUMP_POPUP_STATE_JS,
+            {"label": label, "expectedFiles": [f.lower() for f in expected_files]},
         )
-        logging.info(f"[POPUP_STATE] {label}: inputs={len(state.get('inputs', []))}, continuar={state.get('continuar')}")
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "[POPUP_STATE] %s: inputs=%d, continuar=%s",
+                label,
+                len(state.get("inputs", [])),
+                state.get("continuar"),
+            )
+        logger.debug("[POPUP_STATE] %s: %s", label, state)
     except Exception as e:
-        logging.warning(f"No se pudo dumpear estado del popup ({label}): {e}")
+        logger.warning("No se pudo dumpear estado del popup (%s): %s", label, e)
 
 
-def _normalizar_archivos(archivos: Union[None, Path, Sequence[Path]]) -> List[Path]:
-    if archivos is None:
-        return []
+def _normalizar_archivos(archivos: Union[None, Path, Sequence[Path]]) -> tuple[Path, ...]:
+    if not archivos:  # None o secuencia vacía
+        return ()
     if isinstance(archivos, Path):
-        return [archivos]
-    return [a for a in archivos if a is not None]
+        return (archivos,)
+    if None not in archivos:
+        return tuple(archivos)
+    return tuple(a for a in archivos if a is not None)
 
 
 def _validar_extension(archivo: Path) -> None:
-    ext = archivo.suffix.lower().lstrip(".")
-    if ext not in {"jpg", "jpeg", "pdf"}:
+    ext = archivo.suffix[1:].lower()  # suffix siempre empieza por "." o es ""
+    if ext not in _ALLOWED_EXTS:
         raise ValueError(f"Extensión no permitida: {archivo.name} (solo jpg, jpeg, pdf)")
 
 
-async def _siguiente_input_vacio(popup: Page) -> Optional[int]:
-    inputs = popup.locator("input[type='file']")
-    count = await inputs.count()
-    for i in range(count):
-        try:
-            vacio = await inputs.nth(i).evaluate("(el) => !el.files || el.files.length === 0")
-            if vacio:
-                return i
-        except Exception:
+def _validar_archivo(archivo: Path) -> os.stat_result:
+    """Valida extensión y existencia; devuelve el stat() del archivo."""
+    # Extensión primero (sin syscall); después un único stat(), que ya lanza FileNotFoundError.
+    _validar_extension(archivo)
+    st = archivo.stat()
+    if st.st_size > UPLOAD_WARN_BYTES:
+        logger.warning(
+            "Archivo grande (%.1f MB): %s. La confirmación del popup puede tardar.",
+            st.st_size / (1024 * 1024),
+            archivo.name,
+        )
+    return st
+
+
+async def _validar_archivos(archivos: Sequence[Path]) -> List[os.stat_result]:
+    # stat() fuera del event loop y en paralelo (relevante en rutas de red tipo \\SERVER-DOC).
+    return list(await asyncio.gather(*(asyncio.to_thread(_validar_archivo, a) for a in archivos)))
+
+
+def _deduplicar_archivos(
+    archivos: Sequence[Path], stats: Sequence[os.stat_result]
+) -> tuple[tuple[Path, ...], tuple[os.stat_result, ...]]:
+    """
+    Quita archivos repetidos (misma ruta o mismo fichero físico) conservando el orden.
+    Algunos sistemas de ficheros no informan inodo (st_ino == 0): ahí comparamos por ruta absoluta.
+    """
+    vistos: set[object] = set()
+    unicos: list[Path] = []
+    unicos_stats: list[os.stat_result] = []
+    for a, st in zip(archivos, stats):
+        clave: object = (st.st_dev, st.st_ino) if st.st_ino else str(a.absolute())
+        if clave in vistos:
+            logger.info("Archivo duplicado omitido: %s", a)
             continue
-    return None
+        vistos.add(clave)
+        unicos.append(a)
+        unicos_stats.append(st)
+    return tuple(unicos), tuple(unicos_stats)
+
+
+async def _indices_vacios(inputs: Locator) -> tuple[List[int], bool]:
+    """
+    Índices de todos los input[type=file] sin archivo y si el primero de ellos admite `multiple`
+    (una sola ida y vuelta al navegador).
+    """
+    res = await inputs.evaluate_all(
+        """(els) => {
+            const vacios = [];
+            for (let i = 0; i < els.length; i++) {
+                try {
+                    if (!els[i].files || els[i].files.length === 0) vacios.push(i);
+                } catch (e) {}
+            }
+            const multiple = vacios.length > 0 && !!els[vacios[0]].multiple;
+            return { vacios, multiple };
+        }"""
+    )
+    return list(res["vacios"]), bool(res["multiple"])
+
+
+# Puntuación de un contexto candidato a uploader: nº de inputs de archivo + CTAs típicos de STA.
+_SCORE_UPLOADER_JS = """({ clicar, continuarCss, continuar }) => {
+    const texto = (el) => (el.textContent || '').replace(/\\s+/g, ' ').toLowerCase();
+    let score = document.querySelectorAll("input[type='file']").length;
+    if (Array.from(document.querySelectorAll('a')).some((a) => texto(a).includes(clicar))) score += 10;
+    if (document.querySelector("a[onclick*='uploadFile']")) score += 10;
+    if (Array.from(document.querySelectorAll(continuarCss)).some((a) => texto(a).includes(continuar))) score += 5;
+    return score;
+}"""
 
 
 async def _resolver_contexto_uploader(popup: Page) -> Page | Frame:
     """
     En STA el uploader puede estar en la página principal del popup o en un iframe.
     Elegimos el contexto que realmente contiene los inputs de archivo y (si existe) los CTAs.
+    El resultado se cachea en el popup mientras el frame elegido siga adjunto.
     """
+    cached = getattr(popup, "_xaloc_upload_target", None)
+    if cached is popup or (isinstance(cached, Frame) and not cached.is_detached()):
+        return cached
+
+    main_frame = popup.main_frame
     candidates: list[Page | Frame] = [popup]
-    for fr in popup.frames:
-        if fr == popup.main_frame:
-            continue
-        candidates.append(fr)
+    candidates.extend(fr for fr in popup.frames if fr != main_frame)
+
+    # Sin iframes no hay nada que puntuar: evitamos las consultas por contexto.
+    if len(candidates) == 1:
+        return popup
 
     best: Page | Frame | None = None
     best_score = -1
-    for ctx in candidates:
-        try:
-            inputs_count = await ctx.locator("input[type='file']").count()
-        except Exception:
+    score_args = {"clicar": _CLICAR_TXT.lower(), "continuarCss": _CONTINUAR_CSS, "continuar": _CONTINUAR_TXT.lower()}
+    # Una sola ida y vuelta por contexto (inputs + CTAs), mismos criterios que los locators has_text;
+    # todos los contextos en paralelo (los frames son independientes).
+    scores = await asyncio.gather(
+        *(ctx.evaluate(_SCORE_UPLOADER_JS, score_args) for ctx in candidates),
+        return_exceptions=True,
+    )
+    for ctx, score in zip(candidates, scores):
+        if isinstance(score, BaseException):
             continue
 
-        score = inputs_count
-
-        try:
-            if await ctx.locator("a", has_text=re.compile(r"^Clicar per adjuntar", re.IGNORECASE)).count() > 0:
-                score += 10
-            if await ctx.locator("a[onclick*='uploadFile']").count() > 0:
-                score += 10
-            if await ctx.locator("#continuar a", has_text=re.compile(r"^Continuar$", re.IGNORECASE)).count() > 0:
-                score += 5
-        except Exception:
-            pass
-
         try:
             url = (ctx.url or "").lower()
-            if "upload" in url or "adjuntar" in url:
+            if any(hint in url for hint in _UPLOAD_URL_HINTS):
                 score += 3
         except Exception:
             pass
@@ -293,27 +591,116 @@ async def _resolver_contexto_uploader(popup: Page) -> Page | Frame:
         return popup
 
     try:
-        logging.info(f"Contexto uploader seleccionado: {best.url}")
+        setattr(popup, "_xaloc_upload_target", best)
+    except Exception:
+        # Si Playwright/objetos proxied no permiten atributos, simplemente no cacheamos.
+        pass
+
+    try:
+        logger.debug("Contexto uploader seleccionado: %s", best.url)
     except Exception:
         pass
     return best
 
 
-async def _seleccionar_archivos(popup: Page, archivos: List[Path]) -> Page | Frame:
-    # 1. Esperar a que el popup cargue realmente
-    # Usamos 'domcontentloaded' para asegurar que la URL ha empezado a cargar
-    await popup.wait_for_load_state("domcontentloaded", timeout=15000)
-    
-    # 2. LOCALIZAR CONTEXTO REAL DEL UPLOADER (page o iframe)
-    target = await _resolver_contexto_uploader(popup)
+async def _rellenar_input(inputs: Locator, input_index: int, archivos: List[Path]) -> None:
+    """Asigna `archivos` al input[input_index]; la notificación a STA la hace `_confirmar_selecciones`."""
+    logger.debug("Archivo(s) seleccionado(s) en input[%d]", input_index)
+    await inputs.nth(input_index).set_input_files(archivos)
 
-    # 3. Esperar al selector de archivos (aumentamos a 30s)
+
+# Dispara la lógica STA en orden de índice (algunos inputs se crean dinámicamente y el onchange puede
+# fallar) y, en la misma ida y vuelta, devuelve cuántos archivos retuvo cada input.
+_STEP_AFTER_SELECT_JS = """(els, indices) => indices.map((i) => {
+    const el = els[i];
+    if (!el) return 0;
+    try {
+        if (typeof stepAfterSelect === 'function') stepAfterSelect(el);
+    } catch (e) {}
+    return el.files ? el.files.length : 0;
+})"""
+
+
+async def _confirmar_selecciones(target: Page | Frame, inputs: Locator, esperados: dict[int, int]) -> None:
+    """
+    Notifica a STA las selecciones ya hechas (`{input_index: n_archivos}`) en orden de índice,
+    independientemente del orden en que terminaron los `set_input_files` concurrentes, y confirma
+    que cada input retuvo sus archivos.
+    """
+    orden = sorted(esperados)
+    try:
+        retenidos = await inputs.evaluate_all(_STEP_AFTER_SELECT_JS, orden)
+    except PlaywrightError as e:
+        logger.debug("stepAfterSelect no ejecutado: %s", e)
+        retenidos = [0] * len(orden)
+
+    for input_index, n in zip(orden, retenidos):
+        if n >= esperados[input_index]:
+            continue
+        # Confirmar que el input retuvo el archivo (evita falsos positivos en logs).
+        # Solo si la lectura anterior no bastó: esperamos a la condición real, sin dormir.
+        handle = await inputs.nth(input_index).element_handle()
+        try:
+            await target.wait_for_function(
+                "([el, n]) => !!(el && el.files && el.files.length >= n)",
+                arg=[handle, esperados[input_index]],
+                timeout=5000,
+            )
+        except Exception as e:
+            logger.error("Selección no confirmada en input[%d]: %s", input_index, e)
+            raise RuntimeError(f"El input[{input_index}] no retuvo el archivo tras set_input_files()") from e
+        finally:
+            await handle.dispose()
+
+
+async def _validar_y_deduplicar(archivos_originales: Sequence[Path]) -> tuple[tuple[Path, ...], int]:
+    """Valida y deduplica los archivos; devuelve (archivos_unicos, bytes_totales)."""
+    stats = await _validar_archivos(archivos_originales)
+
+    # Un mismo fichero pasado dos veces solo se sube una vez
+    unicos, stats = _deduplicar_archivos(archivos_originales, stats)
+    return unicos, sum(st.st_size for st in stats)
+
+
+def _timeout_subida_ms(total_bytes: int) -> int:
+    return UPLOAD_OK_MIN_TIMEOUT_MS + total_bytes // UPLOAD_OK_BYTES_PER_MS
+
+
+async def _seleccionar_archivos(popup: Page, archivos: List[Path], *, timeout_ok_ms: int) -> Page | Frame:
     selector = "input[type='file']"
+
+    # 1. Esperar a que el popup cargue realmente (única espera de carga del popup)
+    # Usamos 'domcontentloaded' para asegurar que la URL ha empezado a cargar.
+    # En paralelo esperamos ya al input en el documento principal (el caso habitual). Su reloj arranca
+    # con el de la carga, así que le damos ambos plazos: FILE_INPUT_TIMEOUT_MS sigue contando tras el DCL.
+    anticipo = asyncio.create_task(
+        popup.wait_for_selector(
+            selector, state="attached", timeout=POPUP_LOAD_TIMEOUT_MS + FILE_INPUT_TIMEOUT_MS
+        )
+    )
     try:
-        await target.wait_for_selector(selector, state="attached", timeout=30000)
+        await popup.wait_for_load_state("domcontentloaded", timeout=POPUP_LOAD_TIMEOUT_MS)
+
+        # 2. LOCALIZAR CONTEXTO REAL DEL UPLOADER (page o iframe)
+        target = await _resolver_contexto_uploader(popup)
+    except BaseException:
+        anticipo.cancel()
+        await asyncio.gather(anticipo, return_exceptions=True)
+        raise
+
+    # 3. Esperar al selector de archivos
+    try:
+        if target is popup:
+            await anticipo
+        else:
+            # El uploader vive en un iframe: la espera anticipada no aplica.
+            anticipo.cancel()
+            await asyncio.gather(anticipo, return_exceptions=True)
+            await target.wait_for_selector(selector, state="attached", timeout=FILE_INPUT_TIMEOUT_MS)
     except TimeoutError:
-        logging.error("No se encontró el input[type='file'] en el popup/frame.")
-        await popup.screenshot(path="error_popup_vacio.png")
+        logger.error("No se encontró el input[type='file'] en el popup/frame.")
+        if logger.isEnabledFor(logging.DEBUG):
+            await popup.screenshot(path="error_popup_vacio.png")
         raise
 
     # 4. Subida de archivos - IMPORTANTE: El botón "Clicar per adjuntar" solo se puede
@@ -326,104 +713,122 @@ async def _seleccionar_archivos(popup: Page, archivos: List[Path]) -> Page | Fra
     #    4. UNA SOLA VEZ: Hacer clic en "Clicar per adjuntar"
     #    5. Esperar confirmación
     
-    expected_names = [a.name for a in archivos]
-    await _debug_dump_popup_state(target, label="before_select", expected_files=expected_names)
-    logging.info(f"Seleccionando {len(archivos)} archivo(s)...")
-    
-    for idx, archivo in enumerate(archivos, 1):
-        logging.info(f"Seleccionando archivo {idx}/{len(archivos)}: {archivo.name}")
-        
-        # Buscamos el primer input que esté vacío
-        inputs = target.locator("input[type='file']")
-        count = await inputs.count()
-        
-        input_index = None
-        for i in range(count):
-            vacio = await inputs.nth(i).evaluate("(el) => !el.files || el.files.length === 0")
-            if vacio:
-                input_index = i
-                break
-        
-        if input_index is None:
-            raise RuntimeError("No hay más huecos libres para subir archivos en este popup.")
-        
-        # Seleccionar el archivo
-        logging.info(f"Archivo seleccionado en input[{input_index}]")
-        await inputs.nth(input_index).set_input_files(archivo)
-        # Disparar lógica STA (algunos inputs se crean dinámicamente y el onchange puede fallar)
-        try:
-            await inputs.nth(input_index).evaluate(
-                """(el) => {
-                    try {
-                        if (typeof stepAfterSelect === 'function') stepAfterSelect(el);
-                    } catch (e) {}
-                }"""
+    logger.debug("Seleccionando %d archivo(s)...", len(archivos))
+
+    # Locator único para todo el bucle: no se reconstruye por archivo.
+    inputs = target.locator(selector)
+
+    # Huecos libres en una sola consulta; se consumen en orden sin volver a escanear el DOM.
+    vacios, primero_multiple = await _indices_vacios(inputs)
+    if not vacios:
+        raise RuntimeError("No hay más huecos libres para subir archivos en este popup.")
+    input_index = vacios[0]
+
+    # Si el primer hueco libre admite `multiple`, seleccionamos todos los archivos de una vez.
+    if len(archivos) > 1 and primero_multiple:
+        logger.debug("Input[%d] admite múltiples archivos: selección única de %d", input_index, len(archivos))
+        await _rellenar_input(inputs, input_index, archivos)
+        await _confirmar_selecciones(target, inputs, {input_index: len(archivos)})
+    else:
+        pendientes = list(enumerate(archivos, 1))
+        while pendientes:
+            # Huecos libres conocidos; solo re-consultamos si STA ha creado inputs nuevos
+            if not vacios:
+                vacios, _ = await _indices_vacios(inputs)
+            if not vacios:
+                raise RuntimeError("No hay más huecos libres para subir archivos en este popup.")
+
+            # Los inputs son independientes: rellenamos en paralelo todos los huecos ya conocidos
+            lote = list(zip(vacios, pendientes))
+            vacios = vacios[len(lote):]
+            pendientes = pendientes[len(lote):]
+            for input_index, (idx, archivo) in lote:
+                logger.debug("Seleccionando archivo %d/%d en input[%d]: %s", idx, len(archivos), input_index, archivo.name)
+            await asyncio.gather(
+                *(_rellenar_input(inputs, input_index, [archivo]) for input_index, (_, archivo) in lote)
             )
-        except Exception:
-            pass
-        # Confirmar que el input retuvo el archivo (evita falsos positivos en logs)
-        try:
-            files_len = await inputs.nth(input_index).evaluate("(el) => (el.files ? el.files.length : 0)")
-            if int(files_len or 0) <= 0:
-                raise RuntimeError(f"El input[{input_index}] no retuvo el archivo tras set_input_files()")
-        except Exception as e:
-            logging.error(f"Selección no confirmada en input[{input_index}]: {e}")
-            raise
-        # Espera corta entre selecciones de archivos
-        await popup.wait_for_timeout(500)
+            # stepAfterSelect en orden de índice tras el lote (el gather termina en orden arbitrario)
+            await _confirmar_selecciones(target, inputs, {input_index: 1 for input_index, _ in lote})
 
-        await _debug_dump_popup_state(target, label=f"after_select_{idx}", expected_files=expected_names)
-    
-    logging.info(f"Todos los archivos seleccionados ({len(archivos)}). Ahora haciendo clic en 'Clicar per adjuntar'...")
+    logger.debug("Todos los archivos seleccionados (%d). Ahora haciendo clic en 'Clicar per adjuntar'...", len(archivos))
     
     # CRÍTICO: Hacer clic en "Clicar per adjuntar" UNA SOLA VEZ después de seleccionar TODOS
-    await popup.wait_for_timeout(1000)  # Espera para que el popup procese todas las selecciones
-    await _debug_dump_popup_state(target, label="before_click_adjuntar", expected_files=expected_names)
+    # (cada selección ya se confirmó en _confirmar_selecciones; _click_cta_adjuntar espera al enlace)
+    # Diagnóstico: solo dos dumps (antes del click y tras el OK); el primero ya refleja todas las selecciones.
+    # Guardado en la llamada: sin XALOC_UPLOAD_DEBUG ni se crea la corrutina ni la lista de nombres.
+    if _DEBUG:
+        await _debug_dump_popup_state(
+            target, label="before_click_adjuntar", expected_files=[a.name for a in archivos]
+        )
     await _click_cta_adjuntar(target)
-    logging.info("Click en 'Clicar per adjuntar' ejecutado")
-    await _debug_dump_popup_state(target, label="after_click_adjuntar", expected_files=expected_names)
-    
-    # Espera larga para que el JavaScript del popup procese la subida de TODOS los archivos
-    await popup.wait_for_timeout(2000)
-    
+    logger.debug("Click en 'Clicar per adjuntar' ejecutado")
+
     # Esperar confirmación de que los archivos se subieron correctamente
-    logging.info("Esperando confirmación de subida...")
-    await _wait_upload_ok(target)
-    logging.info(f"Todos los archivos ({len(archivos)}) subidos correctamente")
-    await _debug_dump_popup_state(target, label="after_upload_ok", expected_files=expected_names)
+    # (_wait_upload_ok reacciona en cuanto STA escribe el resultado; sin espera fija previa)
+    logger.debug("Esperando confirmación de subida...")
+    await _wait_upload_ok(target, timeout_ms=timeout_ok_ms)
+    logger.debug("Todos los archivos (%d) subidos correctamente", len(archivos))
+    if _DEBUG:
+        await _debug_dump_popup_state(target, label="after_upload_ok", expected_files=[a.name for a in archivos])
     return target
 
-async def _click_link(ctx: Page | Frame, patron: str) -> None:
-    link = ctx.locator("a", has_text=re.compile(patron, re.IGNORECASE)).first
+async def _click_link(ctx: Page | Frame, texto: str) -> None:
+    link = ctx.locator("a", has_text=texto).first
     await link.wait_for(state="visible", timeout=20000)
     await link.click()
-    try:
-        page = ctx if isinstance(ctx, Page) else ctx.page
-        await page.wait_for_timeout(DELAY_MS)
-    except PlaywrightError:
-        return
 
 
-async def _wait_upload_ok(ctx: Page | Frame) -> None:
+async def _wait_upload_ok(ctx: Page | Frame, *, timeout_ms: int = UPLOAD_OK_MIN_TIMEOUT_MS) -> None:
     # En popup.html el estado se escribe en <div id="uploadResultado">... Document adjuntat</div>
-    page = ctx if isinstance(ctx, Page) else ctx.page
-
-    # Si no existe el indicador, no podemos validar por texto: damos un margen y seguimos.
+    # Si el indicador no aparece en 5 s no podemos validar por texto y seguimos; si existe,
+    # SÍ exigimos ver el OK para evitar "falsos verdes". Todo en una única promesa del navegador.
+    args = {"timeoutMs": timeout_ms, "absentMs": 5000}
     try:
-        await ctx.wait_for_selector("#uploadResultado", state="attached", timeout=5000)
-    except TimeoutError:
-        await page.wait_for_timeout(1000)
+        result = await _evaluar_helper(ctx, "__xalocWaitUploadOk", _UPLOAD_OK_OBSERVER_JS, args)
+    except PlaywrightError as e:
+        # Contexto destruido/navegado durante la espera: volvemos al sondeo de Playwright.
+        logger.warning("Observer de uploadResultado no disponible (%s); usando sondeo", e)
+        try:
+            await ctx.wait_for_selector("#uploadResultado", state="attached", timeout=args["absentMs"])
+        except TimeoutError:
+            return
+        # Igual que _evaluar_helper: si el documento trae el helper, el sondeo solo envía la llamada.
+        try:
+            con_helper = await ctx.evaluate("() => typeof window.__xalocUploadReady === 'function'")
+        except PlaywrightError:
+            con_helper = False
+        predicado = "() => window.__xalocUploadReady()" if con_helper else _UPLOAD_OK_JS
+        await ctx.wait_for_function(predicado, timeout=args["timeoutMs"])
         return
 
-    # Si existe, entonces SÍ exigimos ver el OK para evitar "falsos verdes".
-    await ctx.wait_for_function(
-        """() => {
-            const el = document.getElementById('uploadResultado');
-            if (!el) return false;
-            return /Document\\s+adjuntat/i.test(el.textContent || '');
-        }""",
-        timeout=60000,
-    )
+    if result == "absent":
+        logger.info("Sin indicador #uploadResultado en el popup; no se valida el OK por texto")
+        return
+    if result != "ok":
+        raise TimeoutError(f"Timeout {timeout_ms}ms esperando 'Document adjuntat' en #uploadResultado")
+
+
+_CTA_ADJUNTAR_CSS = (
+    "#adjuntar a[onclick*='uploadFile']",
+    "a[onclick*='uploadFile']",
+    "#firmaBoton a[onclick*='procesoFirma']",
+    "a[onclick*='procesoFirma']",
+)
+
+# Pulsa el primer candidato existente (en orden de prioridad); devuelve su selector o null.
+_CLICK_CTA_ADJUNTAR_JS = """(selectors) => {
+    for (const css of selectors) {
+        const el = document.querySelector(css);
+        if (!el) continue;
+        try {
+            try { el.scrollIntoView({ block: 'center', inline: 'nearest' }); } catch (e) {}
+            el.click();
+            return css;
+        } catch (e) {}
+    }
+    return null;
+}"""
+
 
 async def _click_cta_adjuntar(ctx: Page | Frame) -> None:
     """
@@ -432,179 +837,209 @@ async def _click_cta_adjuntar(ctx: Page | Frame) -> None:
     - el de firma (onclick procesoFirma) puede estar oculto (display:none)
     Por eso NO podemos basarnos solo en el texto ni en `visible`.
     """
-    candidates = [
-        "#adjuntar a[onclick*='uploadFile']",
-        "a[onclick*='uploadFile']",
-        "#firmaBoton a[onclick*='procesoFirma']",
-        "a[onclick*='procesoFirma']",
-    ]
-
-    for css in candidates:
-        loc = ctx.locator(css).first
-        try:
-            if await loc.count() <= 0:
-                continue
-            await loc.wait_for(state="attached", timeout=20000)
-            # click via DOM to bypass visibility constraints (STA oculta/mostrar por CSS)
-            await loc.evaluate(
-                """(el) => {
-                    try { el.scrollIntoView({ block: 'center', inline: 'nearest' }); } catch (e) {}
-                    el.click();
-                }"""
-            )
-            return
-        except Exception:
-            continue
+    # Candidatos por prioridad resueltos y pulsados en una sola evaluación (click DOM: STA oculta/muestra
+    # por CSS, así que no dependemos de la visibilidad).
+    try:
+        usado = await ctx.evaluate(_CLICK_CTA_ADJUNTAR_JS, list(_CTA_ADJUNTAR_CSS))
+    except PlaywrightError as e:
+        logger.debug("Click DOM en 'Clicar per adjuntar' fallido: %s", e)
+        usado = None
+    if usado:
+        logger.debug("Click en 'Clicar per adjuntar' vía %s", usado)
+        return
 
     # Último fallback: por texto (puede dar el oculto, pero al menos deja trazas)
-    await _click_link(ctx, r"^Clicar per adjuntar")
+    await _click_link(ctx, _CLICAR_TXT)
+
 
-async def _adjuntar_y_continuar(popup: Page, *, ctx: Page | Frame, espera_cierre: bool = False) -> None:
+async def _adjuntar_y_continuar(
+    popup: Page,
+    *,
+    ctx: Page | Frame,
+    nombres: Sequence[str],
+    espera_cierre: bool = False,
+) -> bool:
     """
     Sincronización Multi-archivo: Convierte la lista completa a Hexadecimal y 
-    actualiza el DOM para mostrar todos los adjuntos.
-    """
-    logging.info("Esperando confirmación del servidor del popup...")
-    await _wait_upload_ok(ctx)
-
-    # 1. Obtener datos y convertir la LISTA COMPLETA a HEX
-    popup_data = await popup.evaluate("""() => {
-        const params = new URLSearchParams(window.location.search);
-        const fileInputs = Array.from(document.querySelectorAll('input[type="file"]'));
-        const names = fileInputs.map(i => i.value.split(/[\\\\/]/).pop()).filter(Boolean);
-        
-        const toHex = (str) => {
-            let hex = '';
-            for(let i=0; i<str.length; i++) hex += ''+str.charCodeAt(i).toString(16);
-            return hex;
-        };
+    actualiza el DOM para mostrar todos los adjuntos. `nombres` son los nombres (ya sanitizados)
+    de los archivos seleccionados, en orden.
 
-        const fullString = names.join('|');
-        return {
-            tipoDoc: params.get('tipoDocumento') || '',
-            personId: params.get('personDBOID') || '',
-            firma: params.get('firma') || 'S',
-            filesStr: fullString,
-            allFilesHex: toHex(fullString), // Convertimos la cadena completa "A.pdf|B.pdf|C.pdf"
-            displayNames: names.join(', ')
-        };
-    }""")
+    Requiere que la subida ya esté confirmada: `_wait_upload_ok` (llamado al final de
+    `_seleccionar_archivos`) es la única espera del "Document adjuntat".
 
-    # 2. INYECCIÓN NATIVA COMPLETA
-    logging.info(f"[STA_FORCE] Sincronizando multi-archivo: {popup_data['filesStr']}")
-    
-    await popup.evaluate("""(data) => {
-        if (!window.opener || window.opener.closed) return;
-        const o = window.opener;
-        const d = o.document;
+    Devuelve True si (con `espera_cierre`) se observó el cierre del popup tras "Continuar".
+    """
 
-        // A. Registrar la lista completa en el sistema técnico
-        o.addDocumentoLista(data.tipoDoc, data.filesStr, data.firma, '', '', '', data.personId, false, '', '', 'false', null, 'true');
-
-        // B. Actualizar IDs dinámicos (Soportando particular y representante)
-        const suffixes = ['_NEW', '_' + data.personId];
-        
-        suffixes.forEach(sfx => {
-            const idBase = data.tipoDoc + sfx;
-            
-            // Inyectar el HEX de TODOS los archivos (esto es lo que faltaba)
-            const fileInput = d.getElementById(idBase + 'file');
-            if (fileInput) fileInput.value = data.allFilesHex;
-
-            // Gestión de botones
-            const divBtn = d.getElementById('divBoton' + idBase);
-            const divCan = d.getElementById('divCancelar' + idBase);
-            if (divBtn) divBtn.style.display = 'none';
-            if (divCan) divCan.style.display = 'block';
-
-            // Actualización visual de la tabla con todos los nombres
-            const statusCell = d.getElementById('Status' + idBase);
-            if (statusCell) {
-                statusCell.innerHTML = '<span class="adjuntado pdf">' + data.displayNames + '</span>';
-            }
-        });
-        console.log('GEMINI_DEBUG: Sincronización multi-archivo completada en el DOM');
-    }""", popup_data)
+    # 1+2. Datos del popup (lista completa en HEX) e inyección nativa en el opener: una sola evaluación
+    # Los nombres salen de Python (son los que acabamos de seleccionar): no hace falta leer los inputs.
+    popup_data = await _evaluar_helper(popup, "__xalocSyncOpener", _SYNC_OPENER_JS, list(nombres))
+    logger.debug("[STA_FORCE] Sincronización multi-archivo (opener=%s): %s", popup_data["patched"], popup_data["filesStr"])
 
     # 3. Cierre oficial para asegurar persistencia de cookies/sesión
-    btn_continuar = ctx.locator("a", has_text=re.compile(r"^Continuar$", re.IGNORECASE)).first
+    # Selector CSS directo del CTA de popup.html (#continuar a) o, en su defecto, por texto (un solo locator).
+    btn_continuar = ctx.locator(_CONTINUAR_CSS).or_(ctx.locator(_CONTINUAR_LINK)).first
     if await btn_continuar.count() == 0:
-        btn_continuar = popup.locator("a", has_text=re.compile(r"^Continuar$", re.IGNORECASE)).first
+        btn_continuar = popup.locator(_CONTINUAR_CSS).or_(popup.locator(_CONTINUAR_LINK)).first
     
-    await btn_continuar.evaluate("el => el.click()")
+    if not espera_cierre:
+        await btn_continuar.evaluate("el => el.click()")
+        return False
+
+    try:
+        async with popup.expect_event("close", timeout=POPUP_TIMEOUT_MS):
+            try:
+                await btn_continuar.evaluate("el => el.click()")
+            except PlaywrightError as e:
+                # El popup puede cerrarse mientras el evaluate aún está en vuelo. Cualquier otro fallo
+                # (incluido el TimeoutError de un 'Continuar' inexistente) es un error real: no lo
+                # confundimos con el timeout del cierre, que solo se degrada a aviso.
+                if not popup.is_closed():
+                    raise RuntimeError("No se pudo pulsar 'Continuar' en el popup") from e
+                logger.debug("Click en 'Continuar' interrumpido por el cierre del popup: %s", e)
+    except TimeoutError:
+        logger.warning("El popup no se cerró tras 'Continuar'")
+        return False
+    return True
 
-async def subir_documento(page: Page, archivo: Union[None, Path, Sequence[Path]]) -> None:
+async def _cerrar_popup(popup: Page) -> None:
+    try:
+        await popup.close()
+    except PlaywrightError as e:
+        logger.debug("No se pudo cerrar el popup: %s", e)
+
+
+# Localiza el enlace "Adjuntar i signar" (prefiere el que llama a openUploader) y lo pulsa.
+# Devuelve su índice entre los a.docs, o -1 si todavía no hay ninguno.
+_CLICK_DOCS_JS = """() => {
+    const links = Array.from(document.querySelectorAll('a.docs'));
+    if (!links.length) return -1;
+    const idx = links.findIndex(
+        (el) => ((el.getAttribute('onclick') || '') + (el.getAttribute('href') || '')).includes('openUploader')
+    );
+    (links[idx] || links[0]).click();
+    return Math.max(idx, 0);
+}"""
+
+
+async def subir_documento(
+    page: Page,
+    archivo: Union[None, Path, Sequence[Path]],
+    *,
+    timeout_subida_ms: int | None = None,
+) -> None:
     """
     Sube uno o varios documentos adjuntos al trámite usando copias sanitizadas.
+
+    `timeout_subida_ms` fija la espera de confirmación del popup; por defecto se calcula
+    a partir del tamaño total de los archivos.
     """
     archivos_originales = _normalizar_archivos(archivo)
     if not archivos_originales:
-        logging.info("Sin archivos para adjuntar, saltando...")
+        logger.info("Sin archivos para adjuntar, saltando...")
         return
 
-    for a in archivos_originales:
-        if not a.exists():
-            raise FileNotFoundError(str(a))
-        _validar_extension(a)
+    # 1. PREPARACIÓN: validación de ficheros (en hilos) e instalación de hooks en la página principal
+    # en paralelo: no dependen entre sí. Si la validación falla, no se copia ni se abre el popup.
+    (archivos_originales, total_bytes), *_ = await asyncio.gather(
+        _validar_y_deduplicar(archivos_originales),
+        _install_sta_main_hooks(page),  # Monitorizamos funciones internas
+        _instalar_helpers_contexto(page),
+    )
+    if timeout_subida_ms is None:
+        timeout_subida_ms = _timeout_subida_ms(total_bytes)
 
-    # 1. PREPARACIÓN: Usar copias sin espacios para evitar errores de sanitización
-    archivos, transit_dir = _preparar_copias_sanitizadas(archivos_originales)
+    # Copias sin espacios para evitar errores de sanitización (solo si hace falta). Se solapan con la
+    # apertura del popup: el primer consumidor es _seleccionar_archivos.
+    prep = asyncio.create_task(_preparar_copias_sanitizadas(archivos_originales))
+    transit_dir: Path | None = None
 
+    t0 = time.perf_counter()
+    popup = None
     try:
-        logging.info(f"Iniciando subida de {len(archivos)} documento(s)...")
-        _attach_gemini_console_logger(page)
-        await _install_sta_main_hooks(page) # Monitorizamos funciones internas
+        # Trazas intermedias en DEBUG: en INFO se emite un único registro resumen al final.
+        logger.debug("Iniciando subida de %d documento(s)...", len(archivos_originales))
 
         # 2. APERTURA DEL POPUP
-        logging.info("Buscando enlace 'Adjuntar i signar'...")
-        docs_link = page.locator("a.docs").first
-        
-        if await docs_link.count() == 0:
-             raise RuntimeError("No se encuentra el enlace de adjuntar documentos (a.docs)")
-
-        logging.info("Abriendo popup mediante click DOM forzado...")
-        popup = None
+        logger.debug("Abriendo popup mediante click DOM forzado...")
         try:
             async with page.expect_popup(timeout=POPUP_TIMEOUT_MS) as popup_info:
-                # El click vía evaluate dispara el evento openUploader() sin importar CSS
-                await page.evaluate("document.querySelector('a.docs').click()")
+                # El enlace está oculto por CSS, así que click(force=True) no tiene punto de click:
+                # localizamos el a.docs correcto y hacemos el.click() en la misma evaluación (dispara openUploader()).
+                idx = await page.evaluate(_CLICK_DOCS_JS)
+                if idx < 0:
+                    # Aún no está en el DOM: esperamos solo lo necesario (basta con 'attached') y repetimos.
+                    try:
+                        await page.locator("a.docs").first.wait_for(state="attached", timeout=5000)
+                    except TimeoutError as e:
+                        raise RuntimeError("No se encuentra el enlace de adjuntar documentos (a.docs)") from e
+                    idx = await page.evaluate(_CLICK_DOCS_JS)
+                logger.debug("Click en a.docs[%d]", idx)
             popup = await popup_info.value
         except Exception as e:
-            logging.error(f"Fallo crítico abriendo el popup: {e}")
+            logger.error("Fallo crítico abriendo el popup: %s", e)
             raise
 
         # 3. PROCESO DE SUBIDA EN EL POPUP
-        logging.info("Popup detectado. Iniciando selección de archivos...")
-        try:
-            await popup.wait_for_load_state("domcontentloaded")
-        except PlaywrightError:
-            pass
-        
+        logger.debug("Popup detectado. Iniciando selección de archivos...")
+
         # Identificamos el frame correcto y subimos los archivos sanitizados
-        uploader_ctx = await _seleccionar_archivos(popup, archivos)
+        archivos, transit_dir = await prep
+        uploader_ctx = await _seleccionar_archivos(popup, archivos, timeout_ok_ms=timeout_subida_ms)
         
         # Ejecutamos el cierre oficial (El método híbrido de arriba)
-        await _adjuntar_y_continuar(popup, ctx=uploader_ctx, espera_cierre=True)
-
-        # 4. FINALIZACIÓN Y ESPERA DE REFRESCO
-        logging.info("Handoff completado. Esperando a que la página principal procese los datos...")
-        # Damos 3 segundos para que el JS de la página principal procese los tokens
-        await page.wait_for_timeout(3000)
-        
-        # Screenshot de verificación final
-        try:
-            await page.screenshot(path="debug_after_upload_final.png")
-            logging.info("Captura de verificación guardada: debug_after_upload_final.png")
-        except Exception:
-            pass
-
-        logging.info("Documentos subidos y vinculados correctamente.")
+        cerrado = await _adjuntar_y_continuar(
+            popup,
+            ctx=uploader_ctx,
+            nombres=[a.name for a in archivos],
+            espera_cierre=True,
+        )
+        if not cerrado and not popup.is_closed():
+            # Nada posterior lee el popup: lo cerramos en segundo plano sin bloquear el flujo.
+            tarea = asyncio.create_task(_cerrar_popup(popup))
+            _TAREAS_CIERRE.add(tarea)
+            tarea.add_done_callback(_TAREAS_CIERRE.discard)
+
+        # 4. FINALIZACIÓN
+        # No hay espera adicional en la página principal: STA no produce ninguna señal propia tras
+        # "Continuar" más allá del cierre del popup (ya observado en _adjuntar_y_continuar). El
+        # span.adjuntado del opener lo escribe nuestra propia sincronización, así que esperarlo no
+        # verificaría nada.
+        logger.debug("Handoff completado (popup cerrado=%s)", cerrado)
+
+        # Screenshot de verificación final (solo con XALOC_DEBUG_SCREENSHOTS=1: codificar la imagen no es gratis)
+        if _DEBUG_SCREENSHOTS:
+            try:
+                # JPEG: codifica mucho más rápido que PNG y basta para verificar a ojo.
+                await page.screenshot(path="debug_after_upload_final.jpg", type="jpeg", quality=60)
+                logger.debug("Captura de verificación guardada: debug_after_upload_final.jpg")
+            except Exception:
+                pass
+
+        ms = int((time.perf_counter() - t0) * 1000)
+        logger.info(
+            "Documentos subidos y vinculados: %d archivo(s), %d bytes, %d ms",
+            len(archivos),
+            total_bytes,
+            ms,
+            extra={
+                "upload_count": len(archivos),
+                "upload_bytes": total_bytes,
+                "upload_ms": ms,
+                "upload_cerrado": cerrado,
+            },
+        )
 
     finally:
+        if transit_dir is None:
+            # Fallo antes de consumir las copias: esperamos a que terminen para poder limpiarlas.
+            (resultado,) = await asyncio.gather(prep, return_exceptions=True)
+            if isinstance(resultado, tuple):
+                transit_dir = resultado[1]
+
         # Limpieza de la carpeta temporal
-        keep = (os.getenv("XALOC_KEEP_UPLOAD_TRANSIT") or "0").strip().lower() in {"1", "true"}
-        if not keep:
-            shutil.rmtree(transit_dir, ignore_errors=True)
-            logging.info(f"[UPLOAD_TRANSIT] Carpeta temporal eliminada: {transit_dir}")
+        if transit_dir is not None and not _KEEP_TRANSIT:
+            # Borrado en un hilo: no bloquea el event loop (tampoco en la ruta de error).
+            await asyncio.to_thread(_borrar_transit, transit_dir)
+            logger.debug("[UPLOAD_TRANSIT] Carpeta temporal eliminada: %s", transit_dir)
 
 __all__ = ["subir_documento"]
@@ -0,0 +1,128 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from sites.xaloc_girona.flows import documentos
+
+
+def _stat_sin_inodo(st):
+    # Simula un sistema de ficheros que no informa inodo (st_ino == 0)
+    campos = list(st[:10])
+    campos[1] = 0
+    return os.stat_result(campos)
+
+
+class TestDocumentosXaloc(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.base = Path(self._tmp.name)
+        self.transit = self.base / "web_uploads"
+        patcher = patch.object(documentos, "UPLOADS_TRANSIT_DIR", self.transit)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self._tmp.cleanup)
+
+    def _crear(self, nombre, contenido=b"%PDF-1.4"):
+        ruta = self.base / nombre
+        ruta.write_bytes(contenido)
+        return ruta
+
+    async def test_deduplica_por_inodo(self):
+        original = self._crear("a.pdf")
+        enlace = self.base / "enlace.pdf"
+        os.link(original, enlace)
+        otro = self._crear("b.pdf")
+
+        stats = await documentos._validar_archivos([original, enlace, otro])
+        unicos, unicos_stats = documentos._deduplicar_archivos([original, enlace, otro], stats)
+
+        self.assertEqual(unicos, (original, otro))
+        self.assertEqual(len(unicos_stats), 2)
+
+    async def test_deduplica_por_ruta_sin_inodo(self):
+        self._crear("a b.pdf")
+        cwd = os.getcwd()
+        os.chdir(self.base)
+        self.addCleanup(os.chdir, cwd)
+        archivos = [Path("./a b.pdf"), Path("a b.pdf"), self._crear("c.pdf")]
+
+        stats = [_stat_sin_inodo(st) for st in await documentos._validar_archivos(archivos)]
+        unicos, _ = documentos._deduplicar_archivos(archivos, stats)
+
+        self.assertEqual(unicos, (Path("a b.pdf"), self.base / "c.pdf"))
+
+    async def test_sin_copias_si_los_nombres_son_validos(self):
+        archivos = [self._crear("a.pdf"), self._crear("b-1_x.pdf")]
+
+        limpios, run_dir = await documentos._preparar_copias_sanitizadas(archivos)
+
+        self.assertIsNone(run_dir)
+        self.assertEqual(limpios, archivos)
+        self.assertFalse(self.transit.exists())
+
+    async def test_renombra_colisiones_tras_sanitizar(self):
+        con_espacio = self._crear("a b.pdf", b"uno")
+        sin_espacio = self._crear("ab.pdf", b"dos")
+
+        limpios, run_dir = await documentos._preparar_copias_sanitizadas([con_espacio, sin_espacio])
+        try:
+            self.assertEqual([p.name for p in limpios], ["ab.pdf", "2_ab.pdf"])
+            self.assertEqual(run_dir.parent, self.transit)
+            self.assertEqual(limpios[0].read_bytes(), b"uno")
+            self.assertEqual(limpios[1].read_bytes(), b"dos")
+        finally:
+            documentos._borrar_transit(run_dir)
+        self.assertFalse(run_dir.exists())
+
+    async def test_colisiones_sin_distinguir_mayusculas(self):
+        archivos = [self._crear("Doc 1.pdf", b"uno"), self._crear("doc1.pdf", b"dos")]
+
+        limpios, run_dir = await documentos._preparar_copias_sanitizadas(archivos)
+        try:
+            self.assertEqual([p.name for p in limpios], ["Doc1.pdf", "2_doc1.pdf"])
+            self.assertEqual(limpios[0].read_bytes(), b"uno")
+            self.assertEqual(limpios[1].read_bytes(), b"dos")
+        finally:
+            documentos._borrar_transit(run_dir)
+
+    async def test_copias_si_los_nombres_solo_difieren_en_mayusculas(self):
+        (self.base / "otra").mkdir()
+        mayus = self._crear("A.pdf", b"uno")
+        minus = self._crear("otra/a.pdf", b"dos")
+
+        limpios, run_dir = await documentos._preparar_copias_sanitizadas([mayus, minus])
+        try:
+            self.assertIsNotNone(run_dir)
+            self.assertEqual([p.name for p in limpios], ["A.pdf", "2_a.pdf"])
+        finally:
+            documentos._borrar_transit(run_dir)
+
+    def test_enlazar_no_sobrescribe_destino_existente(self):
+        orig1 = self._crear("orig1.pdf", b"uno")
+        orig2 = self._crear("orig2.pdf", b"dos")
+        destino = self.base / "Doc1.pdf"
+        documentos._enlazar_o_copiar(orig1, destino)
+
+        with self.assertRaises(FileExistsError):
+            documentos._enlazar_o_copiar(orig2, destino)
+        self.assertEqual(orig1.read_bytes(), b"uno")
+
+    def test_copia_exclusiva_si_no_se_puede_enlazar(self):
+        orig1 = self._crear("orig1.pdf", b"uno")
+        orig2 = self._crear("orig2.pdf", b"dos")
+        destino = self.base / "Doc1.pdf"
+        os.link(orig1, destino)
+
+        # Enlace no soportado (p.ej. otro volumen): la copia tampoco puede pisar el destino
+        with patch.object(documentos.os, "link", side_effect=OSError("cross-device")):
+            with self.assertRaises(FileExistsError):
+                documentos._enlazar_o_copiar(orig2, destino)
+            documentos._enlazar_o_copiar(orig2, self.base / "Doc2.pdf")
+        self.assertEqual(orig1.read_bytes(), b"uno")
+        self.assertEqual((self.base / "Doc2.pdf").read_bytes(), b"dos")
+
+
+if __name__ == '__main__':
+    unittest.main()